@@ -21,54 +21,175 @@ __version__ = "1.0.0"
 
 
 from os import path
+import os
+from collections import deque
+from collections.abc import Iterable, Iterator
 import asyncio
+import fnmatch
+import functools
+import hashlib
+import itertools
+import json
 import re
+import subprocess
+import sys
+import tempfile
 
 import argparse
-from glob import glob
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
 
 DEFAULT_QUALITY_TRESHOLD = 95
 DEFAULT_TRANSCODE_WORKERS = 1
 DEFAULT_VMAF_WORKERS = 1
 DEFAULT_VMAF_THREADS = 14
-DEFAULT_CQ_STEP = 2
+DEFAULT_VMAF_SUBSAMPLE = 1
+DEFAULT_BATCH_SIZE = 1
+# concurrent nvenc sessions on current geforce drivers
+NVENC_MAX_SESSIONS = 8
+# cpu cores left for the host side of every nvenc session
+NVENC_HOST_THREADS = 2
 DEFAULT_CQ_INITIAL = 40
+CQ_MIN = 0
+CQ_MAX = 50
 DEFAULT_OUT_DIR = "./out"
 DEFAULT_OUT_FILE_EXTENSION = ".mkv"
+DONE_FILE_EXTENSION = ".done"
+DIGEST_CHUNK_SIZE = 1 << 20
+# video codecs nvdec can decode
+NVDEC_CODECS = frozenset(
+    {
+        "av1",
+        "h264",
+        "hevc",
+        "mjpeg",
+        "mpeg1video",
+        "mpeg2video",
+        "mpeg4",
+        "vc1",
+        "vp8",
+        "vp9",
+    }
+)
+# subtitle codecs matroska takes as they are, text ones are converted to ass
+BITMAP_SUBTITLE_CODECS = frozenset(
+    {"dvb_subtitle", "dvd_subtitle", "hdmv_pgs_subtitle", "xsub"}
+)
+CUDA_INPUT_SETTINGS = {"hwaccel": "cuda", "hwaccel_output_format": "cuda"}
+# put on the queues once all work is done, workers exit when they get it
+QUEUE_SENTINEL = None
+# seconds between writes of the collected log lines to stdout
+LOG_FLUSH_INTERVAL = 0.05
+
+# ffmpeg prints the VMAF score at the very end of its log
+VMAF_SCORE_PREFIX = b"VMAF score: "
+_GLOB_MAGIC_RE = re.compile(r"[*?[]")
+_PATH_SEP_RE = re.compile(r"[\\/]" if os.name == "nt" else "/")
+# number of trailing ffmpeg output lines kept after the process exits
+FFMPEG_TAIL_LINES = 64
+# attempts at a probe that finished without a vmaf score before giving up
+VMAF_MAX_RETRIES = 3
+
+
+class CustomAsyncQueue(asyncio.PriorityQueue):
+    """Priority queue of arbitrary items, lower priority values come first and
+    items of equal priority keep their insertion order.
+    """
 
-
-class CustomAsyncQueue(asyncio.Queue):
     def __init__(self, maxsize=0):
         super().__init__(maxsize)
-        self._unfinished_tasks_custom = 0
+        self._seq = itertools.count()
 
-    def put_nowait(self, item) -> None:
-        super().put_nowait(item)
-        self._unfinished_tasks_custom += 1
+    def put_nowait(self, item, priority: int = 0) -> None:
+        super().put_nowait((priority, next(self._seq), item))
 
-    def task_done(self) -> None:
-        super().task_done()
-        self._unfinished_tasks_custom -= 1
+    async def put(self, item, priority: int = 0) -> None:
+        # the queues are unbounded, so putting never has to wait
+        self.put_nowait(item, priority)
+
+    def get_nowait(self):
+        return super().get_nowait()[-1]
 
     def get_unfinished_tasks(self) -> int:
-        return self._unfinished_tasks_custom
+        # asyncio.Queue already counts unfinished tasks for join()
+        return getattr(self, "_unfinished_tasks", self.qsize())
 
 
-def ffmpeg_compile_cmd(
-    input_path: str | list[str],
-    output_path: str,
-    ffmpeg_args: dict,
+def queues_signal_done(done: asyncio.Event, *queues: CustomAsyncQueue) -> bool:
+    if all(q.get_unfinished_tasks() == 0 for q in queues):
+        done.set()
+        return True
+
+    return False
+
+
+_log_q: asyncio.Queue = asyncio.Queue()
+
+
+def log(*values) -> None:
+    _log_q.put_nowait(" ".join(str(value) for value in values))
+
+
+async def log_drain() -> None:
+    """Write the log lines in bulk, until QUEUE_SENTINEL is logged."""
+
+    while True:
+        lines = [await _log_q.get()]
+        while not _log_q.empty():
+            lines.append(_log_q.get_nowait())
+
+        sys.stdout.writelines(
+            f"{line}\n" for line in lines if line is not QUEUE_SENTINEL
+        )
+        sys.stdout.flush()
+
+        if QUEUE_SENTINEL in lines:
+            return
+
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+
+
+@functools.lru_cache(maxsize=1024)
+def _abs(_path: str) -> str:
+    return path.abspath(_path)
+
+
+@functools.lru_cache(maxsize=256)
+def _flag(flag) -> str:
+    return "-" + str(flag)
+
+
+def ffmpeg_compile_args(ffmpeg_args: dict) -> list[str]:
+    args = []
+
+    for flag, arg in ffmpeg_args.items():
+        # a list value repeats the flag, e.g. multiple -map
+        for _arg in arg if isinstance(arg, list) else [arg]:
+            args.extend([_flag(flag), str(_arg)])
+
+    return args
+
+
+def ffmpeg_compile_batch_cmd(
+    jobs: list[tuple[str | list[str], str, dict]],
+    global_args: dict | None = None,
+    input_args: dict | list[dict | None] | None = None,
     override_output: bool = False,
     progress: bool = False,
     nostdin: bool = True,
     nostats: bool = True,
 ) -> list[str]:
+    """Compile a single ffmpeg command out of (inputs, output, args) jobs.
+    Inputs are numbered in job order, so the args can map them by index.
+    input_args is either applied to every input or given per input as a list.
+    """
 
     cmd = ["ffmpeg"]
 
-    if isinstance(input_path, str):
-        input_path = [input_path]
     if override_output:
         cmd.append("-y")
     if progress:
@@ -78,26 +199,136 @@ def ffmpeg_compile_cmd(
     if nostats:
         cmd.append("-nostats")
 
-    for _input in input_path:
-        cmd.extend(["-i", path.abspath(_input)])
+    inputs = []
+    for input_path, _, _ in jobs:
+        if isinstance(input_path, str):
+            inputs.append(input_path)
+        else:
+            inputs.extend(input_path)
 
-    for flag, arg in ffmpeg_args.items():
-        cmd.extend(["-" + str(flag), str(arg)])
+    for i, _input in enumerate(inputs):
+        _input_args = input_args[i] if isinstance(input_args, list) else input_args
+        if _input_args:
+            cmd.extend(ffmpeg_compile_args(_input_args))
+        cmd.extend(["-i", _abs(_input)])
 
-    if output_path == "-":
-        cmd.append(output_path)
-    else:
-        cmd.append(path.abspath(output_path))
+    if global_args:
+        cmd.extend(ffmpeg_compile_args(global_args))
+
+    for _, output_path, ffmpeg_args in jobs:
+        cmd.extend(ffmpeg_compile_args(ffmpeg_args))
+
+        if output_path == "-":
+            cmd.append(output_path)
+        else:
+            cmd.append(_abs(output_path))
 
     return cmd
 
 
+def ffmpeg_compile_cmd(
+    input_path: str | list[str],
+    output_path: str,
+    ffmpeg_args: dict,
+    input_args: dict | list[dict | None] | None = None,
+    override_output: bool = False,
+    progress: bool = False,
+    nostdin: bool = True,
+    nostats: bool = True,
+) -> list[str]:
+
+    return ffmpeg_compile_batch_cmd(
+        [(input_path, output_path, ffmpeg_args)],
+        input_args=input_args,
+        override_output=override_output,
+        progress=progress,
+        nostdin=nostdin,
+        nostats=nostats,
+    )
+
+
+def ffmpeg_filter_escape(value: str) -> str:
+    # escape for both the filter option and the filtergraph level
+    return value.replace("\\", "/").replace(":", "\\\\:")
+
+
+def ffmpeg_help(*ffmpeg_args: str) -> bytes:
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", *ffmpeg_args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return b""
+
+    return result.stdout
+
+
+def ffmpeg_has_filter(name: str) -> bool:
+    pattern = rb"\s" + re.escape(name.encode()) + rb"\s"
+    return re.search(pattern, ffmpeg_help("-filters")) is not None
+
+
+def ffmpeg_has_option(name: str) -> bool:
+    pattern = rb"(?m)^-" + re.escape(name.encode()) + rb"\s"
+    return re.search(pattern, ffmpeg_help("-h", "full")) is not None
+
+
+_media_probe_cache: dict[str, tuple[str | None, str | None]] = {}
+
+
+async def media_probe(in_path: str) -> tuple[str | None, str | None]:
+    """Return the codecs of the first video and subtitle stream of a file."""
+
+    if in_path not in _media_probe_cache:
+        ffprobe_cmd = [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "stream=codec_type,codec_name",
+            "-of",
+            "csv=p=0",
+            _abs(in_path),
+        ]
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *ffprobe_cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            stdout, _ = await process.communicate()
+        except OSError:
+            stdout = b""
+
+        codecs = {}
+        for line in stdout.decode().splitlines():
+            # ffprobe prints codec_name before codec_type
+            codec_name, _, codec_type = line.strip().partition(",")
+            codecs.setdefault(codec_type, codec_name)
+
+        _media_probe_cache[in_path] = (codecs.get("video"), codecs.get("subtitle"))
+
+    return _media_probe_cache[in_path]
+
+
+async def cuda_decodable(in_path: str) -> bool:
+    video_codec, _ = await media_probe(in_path)
+    return video_codec in NVDEC_CODECS
+
+
 async def ffmpeg_run_async(
-    ffmpeg_cmd: list[str], verbose: bool = False
-) -> tuple[str, str]:
+    ffmpeg_cmd: list[str], verbose: bool = False, check: bool = False
+) -> bytes:
 
     if verbose:
-        print(*ffmpeg_cmd)
+        log(*ffmpeg_cmd)
+
+    tail = deque(maxlen=FFMPEG_TAIL_LINES)
+
+    process = None
 
     try:
         process = await asyncio.create_subprocess_exec(
@@ -106,171 +337,804 @@ async def ffmpeg_run_async(
             stderr=asyncio.subprocess.STDOUT,
         )
 
-        stdout, stderr = await process.communicate()
+        async for line in process.stdout:
+            tail.append(line)
+            if verbose:
+                log(line.decode(errors="replace").rstrip("\r\n"))
+
+        await process.wait()
 
     finally:
-        if process.returncode is None:
+        if process is not None and process.returncode is None:
             process.terminate()
 
-    return stdout, stderr
+    # a failed encode would otherwise be passed on to vmaf and retried forever
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(
+            process.returncode, ffmpeg_cmd, output=b"".join(tail)
+        )
 
+    return b"".join(tail)
 
-async def transcode_async(
-    in_path: str, out_path: str, cq: int, verbose: bool = False
-) -> None:
 
+def transcode_settings_get(
+    cq: int, index: int = 0, subtitle_codec: str | None = None
+) -> dict:
+
+    # explicit maps, so a file gets the same streams on its own and in a batch
     transcode_settings = {
+        "map": [f"{index}:v:0", f"{index}:a:0?"],
         "vcodec": "hevc_nvenc",
         "preset": "slow",
         "rc": "vbr",
         "cq": cq,
         "ac": 1,  # squish audio channels to mono
-        "map_metadata": 0,  # preserve metadata
+        "map_metadata": index,  # preserve metadata
     }
 
-    ffmpeg_cmd = ffmpeg_compile_cmd(
-        in_path, out_path, transcode_settings, override_output=True
+    if subtitle_codec is not None:
+        transcode_settings["map"].append(f"{index}:s:0")
+        if subtitle_codec in BITMAP_SUBTITLE_CODECS:
+            transcode_settings["c:s"] = "copy"
+
+    return transcode_settings
+
+
+@functools.lru_cache(maxsize=None)
+def _nvenc_static(subtitle_codec: str | None) -> tuple[str, ...]:
+    # transcode_settings_get() without cq, precompiled for the single file hot path
+    transcode_settings = transcode_settings_get(0, subtitle_codec=subtitle_codec)
+    del transcode_settings["cq"]
+
+    return tuple(ffmpeg_compile_args(transcode_settings))
+
+
+_CUDA_INPUT_STATIC = tuple(ffmpeg_compile_args(CUDA_INPUT_SETTINGS))
+
+
+async def transcode_async(
+    in_path: str, out_path: str, cq: int, verbose: bool = False
+) -> None:
+
+    # decode straight to cuda frames, so they never leave the gpu
+    input_static = _CUDA_INPUT_STATIC if await cuda_decodable(in_path) else ()
+    _, subtitle_codec = await media_probe(in_path)
+
+    ffmpeg_cmd = [
+        "ffmpeg",
+        "-y",
+        "-nostdin",
+        "-nostats",
+        *input_static,
+        "-i",
+        _abs(in_path),
+        *_nvenc_static(subtitle_codec),
+        "-cq",
+        str(cq),
+        _abs(out_path),
+    ]
+    await ffmpeg_run_async(ffmpeg_cmd, verbose=verbose, check=True)
+
+
+def cq_probe_path(out_path: str, cq: int) -> str:
+    root, ext = path.splitext(out_path)
+    return f"{root}.cq{cq}{ext}"
+
+
+def cq_search_create(out_path: str, digest: bool = False) -> dict:
+    return {
+        "lo": CQ_MIN,
+        "hi": CQ_MAX,
+        "best_cq": None,
+        "out_path": out_path,
+        "probes": 0,
+        "retries": 0,
+        "digest": digest,
+    }
+
+
+def cq_search_update(
+    cq_search: dict, reference: str, distorted: str, cq: int, passed: bool
+) -> int | None:
+    """Bisect the cq range of the reference file and return the next cq to try,
+    or None when the search is finished. Keeps the best passing file in out_path.
+    """
+
+    search = cq_search[reference]
+    search["probes"] += 1
+    search["retries"] = 0
+
+    if passed:
+        search["best_cq"] = cq
+        search["lo"] = cq + 1
+        os.replace(distorted, search["out_path"])
+    else:
+        search["hi"] = cq - 1
+
+        if search["lo"] > search["hi"] and search["best_cq"] is None:
+            # nothing passed the threshold, keep the highest quality attempt
+            os.replace(distorted, search["out_path"])
+        else:
+            os.remove(distorted)
+
+    if search["lo"] > search["hi"]:
+        return None
+
+    return (search["lo"] + search["hi"]) // 2
+
+
+def cq_search_retry(cq_search: dict, reference: str, cq: int) -> None:
+    search = cq_search[reference]
+    search["retries"] += 1
+
+    if search["retries"] > VMAF_MAX_RETRIES:
+        raise RuntimeError(
+            f"no vmaf score after {VMAF_MAX_RETRIES} retries! {cq} {reference}"
+        )
+
+
+async def cq_search_advance(
+    transcode_q: CustomAsyncQueue, cq_search: dict, reference: str, new_cq: int | None
+) -> None:
+
+    search = cq_search[reference]
+
+    if new_cq is not None:
+        # files deeper in their search are closer to being finished
+        priority = -search["probes"]
+        await transcode_q.put((reference, search["out_path"], new_cq), priority)
+    else:
+        await asyncio.to_thread(
+            output_marker_write, search["out_path"], search["digest"]
+        )
+
+        log(f"search done! {search['best_cq']} {reference}")
+
+
+async def transcode_batch_async(
+    jobs: list[tuple[str, str, int]], verbose: bool = False
+) -> None:
+
+    outputs = []
+    input_settings = []
+    for i, (in_path, out_path, cq) in enumerate(jobs):
+        _, subtitle_codec = await media_probe(in_path)
+        transcode_settings = transcode_settings_get(cq, i, subtitle_codec)
+        outputs.append((in_path, out_path, transcode_settings))
+
+        if await cuda_decodable(in_path):
+            input_settings.append(CUDA_INPUT_SETTINGS)
+        else:
+            input_settings.append(None)
+
+    ffmpeg_cmd = ffmpeg_compile_batch_cmd(
+        outputs, input_args=input_settings, override_output=True
     )
-    await ffmpeg_run_async(ffmpeg_cmd, verbose=verbose)
+    await ffmpeg_run_async(ffmpeg_cmd, verbose=verbose, check=True)
+
+
+async def queue_get_batch(q: CustomAsyncQueue, batch_size: int) -> list:
+    batch = [await q.get()]
+    if batch[0] is QUEUE_SENTINEL:
+        return batch
+
+    while len(batch) < batch_size and not q.empty():
+        item = q.get_nowait()
+        if item is QUEUE_SENTINEL:
+            # leave it for another worker
+            q.put_nowait(item)
+            break
+        batch.append(item)
+
+    return batch
+
+
+def file_digest(file_path: str) -> str:
+    digest = hashlib.blake2b()
+
+    with open(file_path, "rb") as file:
+        while chunk := file.read(DIGEST_CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def output_marker_remove(out_path: str) -> None:
+    try:
+        os.remove(out_path + DONE_FILE_EXTENSION)
+    except FileNotFoundError:
+        pass
+
+
+def output_marker_write(out_path: str, digest: bool = False) -> None:
+    """Record the size and mtime of a finished output, and with digest its
+    blake2b digest, which reads the whole file.
+    """
+
+    out_stat = os.stat(out_path)
+    marker = {"size": out_stat.st_size, "mtime_ns": out_stat.st_mtime_ns}
+    if digest:
+        marker["blake2b"] = file_digest(out_path)
+
+    with open(out_path + DONE_FILE_EXTENSION, "w") as marker_file:
+        json.dump(marker, marker_file)
+
+
+async def output_is_done(in_path: str, out_path: str, verify: bool = False) -> bool:
+    """An output is done when its search finished (the marker file was written)
+    after the input was last modified, and the output still has the size and
+    mtime recorded in the marker. With verify, the output content has to match
+    the recorded digest as well, outputs finished without one are not done.
+    """
+
+    try:
+        in_stat = os.stat(in_path)
+        out_stat = os.stat(out_path)
+        with open(out_path + DONE_FILE_EXTENSION) as marker_file:
+            marker = json.load(marker_file)
+    except (OSError, ValueError):
+        return False
+
+    if out_stat.st_size == 0 or out_stat.st_mtime < in_stat.st_mtime:
+        return False
+
+    recorded = (marker.get("size"), marker.get("mtime_ns"))
+    if (out_stat.st_size, out_stat.st_mtime_ns) != recorded:
+        # the output changed after its search finished
+        return False
+
+    if verify:
+        if "blake2b" not in marker:
+            return False
+        return await asyncio.to_thread(file_digest, out_path) == marker["blake2b"]
+
+    return True
 
 
 async def transcode_worker(
     transcode_q: CustomAsyncQueue,
     vmaf_q: CustomAsyncQueue,
+    done: asyncio.Event,
+    batch_size: int = DEFAULT_BATCH_SIZE,
     verbose: bool = False,
 ) -> None:
 
     while True:
-        in_path, out_path, cq = await transcode_q.get()
+        batch = await queue_get_batch(transcode_q, batch_size)
+        if batch[0] is QUEUE_SENTINEL:
+            break
 
-        print(f"transcode start! {cq} {in_path}")
+        jobs = []
+        for in_path, out_path, cq in batch:
+            log(f"transcode start! {cq} {in_path}")
+            jobs.append((in_path, cq_probe_path(out_path, cq), cq))
 
-        await transcode_async(in_path, out_path, cq, verbose=verbose)
+        if len(jobs) == 1:
+            await transcode_async(*jobs[0], verbose=verbose)
+        else:
+            await transcode_batch_async(jobs, verbose=verbose)
 
-        await vmaf_q.put((out_path, in_path, cq))
-        transcode_q.task_done()
+        for in_path, probe_path, cq in jobs:
+            await vmaf_q.put((probe_path, in_path, cq))
+            transcode_q.task_done()
+            queues_signal_done(done, transcode_q, vmaf_q)
 
-        print(f"transcode done! {cq} {in_path}")
+            log(f"transcode done! {cq} {in_path}")
 
 
 def vmaf_get_score(stdout: bytes) -> float | None:
-    match = re.search(r"(?<=VMAF score: )\d+\.\d+", stdout.decode())
+    start = stdout.rfind(VMAF_SCORE_PREFIX)
+    if start < 0:
+        return None
 
-    if match:
-        return float(match.group())
-    else:
+    start += len(VMAF_SCORE_PREFIX)
+    end = stdout.find(b"\n", start)
+    if end < 0:
+        end = len(stdout)
+
+    try:
+        return float(stdout[start:end])
+    except ValueError:
         return None
 
 
+def vmaf_filter_compile(
+    inputs: str,
+    threads: int,
+    subsample: int = DEFAULT_VMAF_SUBSAMPLE,
+    cuda: bool = False,
+) -> str:
+
+    vmaf_filter = "libvmaf_cuda" if cuda else "libvmaf"
+
+    return f"{inputs}{vmaf_filter}=n_threads={threads}:n_subsample={subsample}"
+
+
+def vmaf_inputs_compile(
+    first_index: int = 0, cuda: bool = False
+) -> tuple[str, list[dict | None]]:
+    """Return the filtergraph inputs of a distorted and reference pair for libvmaf
+    and their input settings. With cuda, the distorted file (our own hevc_nvenc
+    output) is decoded by nvdec. The reference is decoded on the cpu and uploaded
+    with hwupload_cuda, nvdec cannot decode every profile (h264 high 10, 4:2:2).
+    """
+
+    distorted, reference = first_index, first_index + 1
+
+    if not cuda:
+        return f"[{distorted}:v][{reference}:v]", [None, None]
+
+    inputs = f"[{reference}:v]hwupload_cuda[upload{reference}];"
+    inputs += f"[{distorted}:v][upload{reference}]"
+    return inputs, [CUDA_INPUT_SETTINGS, None]
+
+
 async def vmaf_async(
-    distorted_path: str, reference_path: str, threads: int, verbose: bool = False
+    distorted_path: str,
+    reference_path: str,
+    threads: int,
+    subsample: int = DEFAULT_VMAF_SUBSAMPLE,
+    cuda: bool = False,
+    verbose: bool = False,
 ) -> float | None:
 
+    inputs, input_settings = vmaf_inputs_compile(cuda=cuda)
+
     vmaf_settings = {
-        "filter_complex": f"libvmaf=n_threads={threads}",
+        "filter_complex": vmaf_filter_compile(inputs, threads, subsample, cuda),
         "f": "null",
     }
 
     ffmpeg_cmd = ffmpeg_compile_cmd(
-        [distorted_path, reference_path], "-", vmaf_settings
+        [distorted_path, reference_path], "-", vmaf_settings, input_settings
     )
 
-    stdout, _ = await ffmpeg_run_async(ffmpeg_cmd, verbose=verbose)
+    stdout = await ffmpeg_run_async(ffmpeg_cmd, verbose=verbose, check=True)
     vmaf_score = vmaf_get_score(stdout)
 
     return vmaf_score
 
 
+def vmaf_read_log(log_path: str) -> float | None:
+    try:
+        with open(log_path) as log_file:
+            return float(json.load(log_file)["pooled_metrics"]["vmaf"]["mean"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+async def vmaf_batch_async(
+    jobs: list[tuple[str, str]],
+    threads: int,
+    subsample: int = DEFAULT_VMAF_SUBSAMPLE,
+    cuda: bool = False,
+    verbose: bool = False,
+) -> list[float | None]:
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_paths = []
+        vmaf_filters = []
+        outputs = []
+        input_settings = []
+
+        for i, (distorted_path, reference_path) in enumerate(jobs):
+            log_path = path.join(log_dir, f"{i}.json")
+            inputs, pair_settings = vmaf_inputs_compile(2 * i, cuda)
+            input_settings.extend(pair_settings)
+            vmaf_filter = vmaf_filter_compile(inputs, threads, subsample, cuda)
+            vmaf_filter += f":log_fmt=json:log_path={ffmpeg_filter_escape(log_path)}"
+
+            log_paths.append(log_path)
+            vmaf_filters.append(f"{vmaf_filter}[vmaf{i}]")
+            vmaf_settings = {"map": f"[vmaf{i}]", "f": "null"}
+            outputs.append(([distorted_path, reference_path], "-", vmaf_settings))
+
+        ffmpeg_cmd = ffmpeg_compile_batch_cmd(
+            outputs, {"filter_complex": ";".join(vmaf_filters)}, input_settings
+        )
+        await ffmpeg_run_async(ffmpeg_cmd, verbose=verbose, check=True)
+
+        return [vmaf_read_log(log_path) for log_path in log_paths]
+
+
+async def vmaf_scores_get(
+    jobs: list[tuple[str, str]],
+    threads: int,
+    subsample: int = DEFAULT_VMAF_SUBSAMPLE,
+    cuda: bool = False,
+    verbose: bool = False,
+) -> list[float | None]:
+
+    if len(jobs) == 1:
+        distorted, reference = jobs[0]
+        return [
+            await vmaf_async(
+                distorted, reference, threads, subsample, cuda, verbose=verbose
+            )
+        ]
+
+    return await vmaf_batch_async(jobs, threads, subsample, cuda, verbose=verbose)
+
+
 async def vmaf_worker(
     transcode_q: CustomAsyncQueue,
     vmaf_q: CustomAsyncQueue,
+    done: asyncio.Event,
     threshold: float,
     threads: int,
+    cq_search: dict,
+    subsample: int = DEFAULT_VMAF_SUBSAMPLE,
+    cuda: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
     verbose: bool = False,
-    cq_step: int = DEFAULT_CQ_STEP,
 ) -> None:
 
     while True:
-        distorted, reference, cq = await vmaf_q.get()
+        batch = await queue_get_batch(vmaf_q, batch_size)
+        if batch[0] is QUEUE_SENTINEL:
+            break
+
+        for distorted, reference, cq in batch:
+            log(f"vmaf start! {cq} {reference}")
+
+        jobs = [(distorted, reference) for distorted, reference, _ in batch]
+        try:
+            vmaf_scores = await vmaf_scores_get(
+                jobs, threads, subsample, cuda, verbose=verbose
+            )
+        except subprocess.CalledProcessError:
+            if not cuda:
+                raise
+
+            # hwupload_cuda does not take every pixel format (4:2:2 for one)
+            log("libvmaf_cuda failed! falling back to libvmaf")
+            vmaf_scores = await vmaf_scores_get(
+                jobs, threads, subsample, verbose=verbose
+            )
 
-        print(f"vmaf start! {cq} {reference}")
+        for (distorted, reference, cq), vmaf_score in zip(batch, vmaf_scores):
+            if vmaf_score is not None:
+                new_cq = cq_search_update(
+                    cq_search, reference, distorted, cq, vmaf_score >= threshold
+                )
+                await cq_search_advance(transcode_q, cq_search, reference, new_cq)
 
-        vmaf_score = await vmaf_async(distorted, reference, threads, verbose=verbose)
+                log(f"vmaf done! {cq} {reference}  Score: {vmaf_score:.2f}")
+            else:
+                cq_search_retry(cq_search, reference, cq)
+                await vmaf_q.put((distorted, reference, cq))
 
-        if vmaf_score is not None:
-            new_cq = cq - cq_step
+                log(f"vmaf failed! {cq} {reference} retrying!")
+
+            vmaf_q.task_done()
+            queues_signal_done(done, transcode_q, vmaf_q)
+
+
+async def transcode_and_vmaf_async(
+    in_path: str,
+    out_path: str,
+    cq: int,
+    threads: int,
+    subsample: int = DEFAULT_VMAF_SUBSAMPLE,
+    cuda: bool = False,
+    verbose: bool = False,
+) -> float | None:
+
+    # the loopback decoder "-dec 0:0" (ffmpeg >= 7.1) decodes the freshly encoded
+    # video stream, so it is compared against the source in the same process
+    if cuda:
+        vmaf_inputs = "[dec:0]hwupload_cuda[d];[0:v]hwupload_cuda[r];[d][r]"
+    else:
+        vmaf_inputs = "[dec:0][0:v]"
+
+    vmaf_filter = vmaf_filter_compile(vmaf_inputs, threads, subsample, cuda)
+
+    _, subtitle_codec = await media_probe(in_path)
+
+    ffmpeg_cmd = ffmpeg_compile_cmd(
+        in_path,
+        out_path,
+        transcode_settings_get(cq, subtitle_codec=subtitle_codec),
+        override_output=True,
+    )
+    ffmpeg_cmd.extend(["-dec", "0:0", "-filter_complex", vmaf_filter + "[vmaf]"])
+    ffmpeg_cmd.extend(["-map", "[vmaf]", "-f", "null", "-"])
+
+    stdout = await ffmpeg_run_async(ffmpeg_cmd, verbose=verbose, check=True)
+    vmaf_score = vmaf_get_score(stdout)
+
+    return vmaf_score
+
+
+async def fused_worker(
+    transcode_q: CustomAsyncQueue,
+    done: asyncio.Event,
+    threshold: float,
+    threads: int,
+    cq_search: dict,
+    subsample: int = DEFAULT_VMAF_SUBSAMPLE,
+    cuda: bool = False,
+    verbose: bool = False,
+) -> None:
+
+    while True:
+        item = await transcode_q.get()
+        if item is QUEUE_SENTINEL:
+            break
+
+        in_path, out_path, cq = item
+
+        log(f"transcode and vmaf start! {cq} {in_path}")
+
+        probe_path = cq_probe_path(out_path, cq)
+        try:
+            vmaf_score = await transcode_and_vmaf_async(
+                in_path, probe_path, cq, threads, subsample, cuda, verbose=verbose
+            )
+        except subprocess.CalledProcessError:
+            if not cuda:
+                raise
+
+            log(f"libvmaf_cuda failed! {cq} {in_path} falling back to libvmaf")
+            vmaf_score = await transcode_and_vmaf_async(
+                in_path, probe_path, cq, threads, subsample, verbose=verbose
+            )
 
-            if vmaf_score < threshold and new_cq >= 0:
-                await transcode_q.put((reference, distorted, new_cq))
+        if vmaf_score is not None:
+            new_cq = cq_search_update(
+                cq_search, in_path, probe_path, cq, vmaf_score >= threshold
+            )
+            await cq_search_advance(transcode_q, cq_search, in_path, new_cq)
 
-            print(f"vmaf done! {cq} {reference}  Score: {vmaf_score:.2f}")
+            log(f"transcode and vmaf done! {cq} {in_path}  Score: {vmaf_score:.2f}")
         else:
-            await vmaf_q.put((distorted, reference, cq))
+            cq_search_retry(cq_search, in_path, cq)
+            await transcode_q.put((in_path, out_path, cq))
+
+            log(f"transcode and vmaf failed! {cq} {in_path} retrying!")
+
+        transcode_q.task_done()
+        queues_signal_done(done, transcode_q)
+
+
+def nvenc_session_limit() -> int | None:
+    if pynvml is None:
+        return None
+
+    try:
+        pynvml.nvmlInit()
+        try:
+            handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+            capacity = pynvml.nvmlDeviceGetEncoderCapacity(
+                handle, pynvml.NVML_ENCODER_QUERY_HEVC
+            )
+        finally:
+            pynvml.nvmlShutdown()
+    except pynvml.NVMLError:
+        return None
+
+    # capacity is the percentage of the encoder still available
+    return max(1, capacity * NVENC_MAX_SESSIONS // 100)
+
+
+def workers_limit(
+    n_transcode_workers: int,
+    n_vmaf_workers: int,
+    threads: int,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    fused: bool = False,
+) -> tuple[int, int, int]:
+    """Clamp the worker counts to the nvenc sessions and cpu cores available."""
+
+    if fused:
+        # fused workers take a single file at a time
+        batch_size = 1
+
+    sessions = nvenc_session_limit()
+    # every file in a transcode batch opens its own nvenc session
+    if sessions is not None and n_transcode_workers * batch_size > sessions:
+        n_transcode_workers = max(1, sessions // batch_size)
+        log(f"transcode workers limited to {n_transcode_workers} by nvenc sessions")
+
+    cores = max(1, (os.cpu_count() or 1) - n_transcode_workers * NVENC_HOST_THREADS)
+
+    # every libvmaf instance runs its own threads, fused workers run one each
+    # and vmaf workers one per file of their batch
+    if fused:
+        vmaf_instances = n_transcode_workers
+    else:
+        vmaf_instances = n_vmaf_workers * batch_size
 
-            print(f"vmaf failed! {cq} {reference} retrying!")
+    if vmaf_instances * threads > cores:
+        if not fused:
+            n_vmaf_workers = max(1, min(n_vmaf_workers, cores // batch_size))
+            vmaf_instances = n_vmaf_workers * batch_size
 
-        vmaf_q.task_done()
+        threads = max(1, cores // vmaf_instances)
+        log(
+            f"vmaf limited to {vmaf_instances} instances with {threads} threads "
+            + f"by {cores} available cpu cores"
+        )
+
+    return n_transcode_workers, n_vmaf_workers, threads
 
 
 def workers_create(
+    tg: asyncio.TaskGroup,
     transcode_q: CustomAsyncQueue,
     vmaf_q: CustomAsyncQueue,
+    done: asyncio.Event,
     n_transcode_workers: int,
     n_vmaf_workser: int,
     threshold: float,
     threads: int,
+    cq_search: dict,
+    subsample: int = DEFAULT_VMAF_SUBSAMPLE,
+    cuda: bool = False,
+    fused: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
     verbose: bool = False,
 ) -> list[asyncio.Task]:
 
     worker_tasks = []
 
+    if fused:
+        for _ in range(n_transcode_workers):
+            worker_tasks.append(
+                tg.create_task(
+                    fused_worker(
+                        transcode_q,
+                        done,
+                        threshold,
+                        threads,
+                        cq_search,
+                        subsample,
+                        cuda,
+                        verbose=verbose,
+                    )
+                )
+            )
+        return worker_tasks
+
     for _ in range(n_transcode_workers):
         worker_tasks.append(
-            asyncio.create_task(transcode_worker(transcode_q, vmaf_q, verbose=verbose))
+            tg.create_task(
+                transcode_worker(transcode_q, vmaf_q, done, batch_size, verbose=verbose)
+            )
         )
     for _ in range(n_vmaf_workser):
         worker_tasks.append(
-            asyncio.create_task(
-                vmaf_worker(transcode_q, vmaf_q, threshold, threads, verbose=verbose)
+            tg.create_task(
+                vmaf_worker(
+                    transcode_q,
+                    vmaf_q,
+                    done,
+                    threshold,
+                    threads,
+                    cq_search,
+                    subsample,
+                    cuda,
+                    batch_size,
+                    verbose=verbose,
+                )
             )
         )
 
     return worker_tasks
 
 
-def deduplicate_files(files: list[str]) -> list[str]:
-    return list(dict.fromkeys(files))
+def _files_find_parts(directory: str, parts: list[str]) -> Iterator[str]:
+    part, parts = parts[0], parts[1:]
+
+    if not _GLOB_MAGIC_RE.search(part):
+        file_path = path.join(directory, part) if directory else part
+        if parts:
+            if path.isdir(file_path):
+                yield from _files_find_parts(file_path, parts)
+        elif path.lexists(file_path):
+            yield file_path
+        return
+
+    # same matching rules as glob: case insensitive on windows, hidden files
+    # only when asked for explicitly
+    flags = re.IGNORECASE if os.name == "nt" else 0
+    pattern = re.compile(fnmatch.translate(part), flags)
+    hidden = part.startswith(".")
+
+    try:
+        entries = os.scandir(directory or os.curdir)
+    except OSError:
+        return
 
+    with entries:
+        for entry in entries:
+            if not pattern.match(entry.name):
+                continue
+            if entry.name.startswith(".") and not hidden:
+                continue
 
-def queues_populate(
+            file_path = path.join(directory, entry.name) if directory else entry.name
+            if not parts:
+                yield file_path
+            elif entry.is_dir():
+                yield from _files_find_parts(file_path, parts)
+
+
+def files_find(patterns: Iterable[str]) -> Iterator[str]:
+    """Lazily expand glob patterns with os.scandir."""
+
+    for pattern in patterns:
+        drive, rest = path.splitdrive(pattern)
+
+        root = drive
+        if _PATH_SEP_RE.match(rest):
+            root += os.sep
+
+        parts = [part for part in _PATH_SEP_RE.split(rest) if part]
+        if parts:
+            yield from _files_find_parts(root, parts)
+        elif root and path.lexists(root):
+            yield root
+
+
+def deduplicate_files(files: Iterable[str]) -> Iterator[str]:
+    seen = set()
+
+    for file in files:
+        # the same file can be matched by differently spelled patterns
+        key = path.normcase(_abs(file))
+        if key not in seen:
+            seen.add(key)
+            yield file
+
+
+async def queues_populate(
     transcode_q: CustomAsyncQueue,
     vmaf_q: CustomAsyncQueue,
-    input_files: list[str],
+    cq_search: dict,
+    input_files: Iterable[str],
     output_dir: str,
     init_cq: int,
     out_file_extension: str = DEFAULT_OUT_FILE_EXTENSION,
+    overwrite: bool = False,
+    verify: bool = False,
 ) -> None:
 
-    input_files = deduplicate_files(input_files)
-
-    for input_file in input_files:
+    for input_file in deduplicate_files(input_files):
         out_name = path.basename(path.splitext(input_file)[0] + out_file_extension)
         out_path = path.normpath(path.join(output_dir, out_name))
+
+        if not overwrite and await output_is_done(input_file, out_path, verify):
+            log(f"already done! {input_file}")
+            continue
+
+        # the output is about to be replaced, it is not finished until the
+        # search writes a new marker
+        output_marker_remove(out_path)
+
+        cq_search[input_file] = cq_search_create(out_path, verify)
         transcode_q.put_nowait((input_file, out_path, init_cq))
 
+        # let the workers start on the files found so far
+        await asyncio.sleep(0)
+
 
 async def queues_wait_for_done(
     transcode_q: CustomAsyncQueue,
     vmaf_q: CustomAsyncQueue,
+    done: asyncio.Event,
     worker_tasks: list[asyncio.Task],
 ) -> None:
 
-    while transcode_q.get_unfinished_tasks() > 0 or vmaf_q.get_unfinished_tasks() > 0:
-        await transcode_q.join()
-        await vmaf_q.join()
+    # the event may have been set while the queues were still being populated
+    while not queues_signal_done(done, transcode_q, vmaf_q):
+        done.clear()
+        await done.wait()
 
-    for task in worker_tasks:
-        task.cancel()
+    # one sentinel per worker on both queues is enough for every worker kind
+    for _ in worker_tasks:
+        transcode_q.put_nowait(QUEUE_SENTINEL)
+        vmaf_q.put_nowait(QUEUE_SENTINEL)
 
 
 async def main() -> None:
@@ -290,10 +1154,10 @@ async def main() -> None:
         "--init-cq",
         type=int,
         default=DEFAULT_CQ_INITIAL,
-        choices=range(0, 51),
-        metavar="[0 - 50]",
+        choices=range(CQ_MIN, CQ_MAX + 1),
+        metavar=f"[{CQ_MIN} - {CQ_MAX}]",
         help="initial constant quality (cq) value to transcode with, "
-        + f"decreases by {DEFAULT_CQ_STEP} on every step",
+        + "next values are found by a binary search over the whole cq range",
     )
     parser.add_argument(
         "-q",
@@ -324,28 +1188,104 @@ async def main() -> None:
         default=DEFAULT_VMAF_WORKERS,
         help="number of paralel workers to compute vmaf on",
     )
+    parser.add_argument(
+        "--vmaf-subsample",
+        type=int,
+        default=DEFAULT_VMAF_SUBSAMPLE,
+        choices=range(1, 1001),
+        metavar="[1 - 1000]",
+        help="compute vmaf on every n-th frame only, higher values speed up "
+        + "the vmaf pass at the cost of a less accurate score",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="transcode and compute vmaf in a single ffmpeg process, uses "
+        + "--transcode-workers workers and requires ffmpeg >= 7.1, "
+        + "worth it mostly together with libvmaf_cuda",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="max number of queued files a worker handles in a single ffmpeg "
+        + "process, amortizes the ffmpeg and nvenc startup for short files, "
+        + "ignored with --fused",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="transcode again files which already have a finished output",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="store a blake2b digest of outputs when their search finishes and "
+        + "check finished outputs against it before skipping them, reads the "
+        + "whole output each time, outputs finished without it are transcoded "
+        + "again",
+    )
     args = parser.parse_args()
 
-    input_files = []
-    for input_str in args.input:
-        input_files.extend(glob(input_str))
+    # loopback decoders (-dec) were added in ffmpeg 7.1
+    if args.fused and not ffmpeg_has_option("dec"):
+        parser.error("--fused requires ffmpeg >= 7.1 with loopback decoder support")
 
-    transcode_q = CustomAsyncQueue()
-    vmaf_q = CustomAsyncQueue()
+    log_task = asyncio.create_task(log_drain())
 
-    queues_populate(transcode_q, vmaf_q, input_files, args.output, args.init_cq)
+    try:
+        args.transcode_workers, args.vmaf_workers, args.threads = workers_limit(
+            args.transcode_workers,
+            args.vmaf_workers,
+            args.threads,
+            args.batch_size,
+            args.fused,
+        )
 
-    worker_tasks = workers_create(
-        transcode_q,
-        vmaf_q,
-        args.transcode_workers,
-        args.vmaf_workers,
-        args.quality_treshold,
-        args.threads,
-        args.verbose,
-    )
+        vmaf_cuda = ffmpeg_has_filter("libvmaf_cuda")
+        if args.verbose:
+            log(f"libvmaf_cuda {'available' if vmaf_cuda else 'not available'}")
+
+        transcode_q = CustomAsyncQueue()
+        vmaf_q = CustomAsyncQueue()
+        cq_search = {}
+
+        done = asyncio.Event()
+
+        async with asyncio.TaskGroup() as tg:
+            worker_tasks = workers_create(
+                tg,
+                transcode_q,
+                vmaf_q,
+                done,
+                args.transcode_workers,
+                args.vmaf_workers,
+                args.quality_treshold,
+                args.threads,
+                cq_search,
+                args.vmaf_subsample,
+                vmaf_cuda,
+                args.fused,
+                args.batch_size,
+                args.verbose,
+            )
 
-    await queues_wait_for_done(transcode_q, vmaf_q, worker_tasks)
+            await queues_populate(
+                transcode_q,
+                vmaf_q,
+                cq_search,
+                files_find(args.input),
+                args.output,
+                args.init_cq,
+                overwrite=args.overwrite,
+                verify=args.verify,
+            )
+
+            await queues_wait_for_done(transcode_q, vmaf_q, done, worker_tasks)
+
+    finally:
+        _log_q.put_nowait(QUEUE_SENTINEL)
+        await log_task
 
 
 if __name__ == "__main__":